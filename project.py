@@ -1,36 +1,101 @@
+import io
+import os
 import zipfile
 import itertools
+import hashlib
+import pickle
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# libgomp reads this when tesserocr loads it, so it has to be set before the import to keep Tesseract
+# single-threaded in each worker process
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
 
 from PIL import Image, ImageDraw, ImageFont
-import pytesseract
+import tesserocr
 import cv2 as cv
 import numpy as np
 
-FONT = ImageFont.truetype('readonly/fanwood-webfont.ttf', size=30)
-face_cascade = cv.CascadeClassifier('readonly/haarcascade_frontalface_default.xml')
-eye_cascade = cv.CascadeClassifier('readonly/haarcascade_eye.xml')
+# The font is only needed for contact sheets in the main process, see get_font()
+FONT = None
+OCR_CACHE_FILE = 'ocr_cache.pkl'
+# LSTM engine only, treating each page as one uniform block of text
+TESSERACT_OPTIONS = {'lang': 'eng', 'oem': tesserocr.OEM.LSTM_ONLY, 'psm': tesserocr.PSM.SINGLE_BLOCK}
+# Cascades are loaded in each worker process by init_worker(), they can't be pickled
+face_cascade = None
+eye_cascade = None
+# Threads each worker uses to search stripes of tall pages, see get_bounding_boxes()
+STRIPE_THREADS = 2
+stripe_pool = None
+# The in-process Tesseract API, one per process, see get_tess_api()
+tess_api = None
+ocr_cache = {}
+
 
-def cvt_color(img_list):
-    """Use CV to convert img to an image array
+def init_worker(cache=None):
+    """Initializer for the worker processes: loads the haar cascades and a single-threaded Tesseract API
     
-    :param img_list:
-    :return: No return, modifies dictionary of image information in place
+    OpenCV is kept to one thread and stripes get a small pool, there is already one worker process per CPU
+    
+    :param cache: A dictionary of OCR results keyed by image hash, from load_ocr_cache()
+    :return: No return, sets the module level cascades, stripe threads, Tesseract API and OCR cache
     """
-    for img in img_list:
-        img['gray'] = cv.cvtColor(img['cv'], cv.COLOR_BGR2GRAY)
+    global face_cascade, eye_cascade, ocr_cache, stripe_pool
+    ocr_cache = cache if cache is not None else {}
+    cv.setNumThreads(1)
+    stripe_pool = ThreadPoolExecutor(max_workers=STRIPE_THREADS)
+    face_cascade = cv.CascadeClassifier('readonly/haarcascade_frontalface_default.xml')
+    eye_cascade = cv.CascadeClassifier('readonly/haarcascade_eye.xml')
+    get_tess_api()
 
 
-def adaptive_threshold(img_list):
-    """Uses CV adaptiveThreshold() to implement Gaussian Thresholding
+def get_tess_api():
+    """Creates the Tesseract API the first time it's needed, so the trained data is loaded once per process
     
-    :param img_list:
-    :return: No return, modifies dictionary of image info
+    :return tess_api: The module level tesserocr.PyTessBaseAPI
     """
-    for img in img_list:
-        img['thresh'] = cv.adaptiveThreshold(img['gray'],255,cv.ADAPTIVE_THRESH_GAUSSIAN_C, cv.THRESH_BINARY, 25, 4)
-        
-        
-def get_bounding_boxes(image_array, cascade, size=(80,80), scale=1.3, minN=3):
+    global tess_api
+    if tess_api is None:
+        tess_api = tesserocr.PyTessBaseAPI(**TESSERACT_OPTIONS)
+    return tess_api
+
+
+def get_font():
+    """Loads the contact sheet font the first time it's needed so worker processes never parse it
+    
+    :return FONT: The module level ImageFont
+    """
+    global FONT
+    if FONT is None:
+        FONT = ImageFont.truetype('readonly/fanwood-webfont.ttf', size=30)
+    return FONT
+
+
+def load_ocr_cache(path=OCR_CACHE_FILE):
+    """Loads the OCR results saved by earlier runs
+    
+    :param path: The path of the pickled cache
+    :return cache: A dictionary of page text keyed by image hash, empty if there is no cache yet
+    """
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+
+def save_ocr_cache(cache, path=OCR_CACHE_FILE):
+    """Saves the OCR results so later runs can skip Tesseract for pages already seen
+    
+    :param cache: A dictionary of page text keyed by image hash
+    :param path: The path of the pickled cache
+    :return: None
+    """
+    with open(path, 'wb') as f:
+        pickle.dump(cache, f)
+
+
+def get_bounding_boxes(image_array, cascade, size=(80,80), scale=1.3, minN=3, max_size=(300,300)):
     """Get bounding boxes for a cascade in a picture
     
     :param image_array: An image array
@@ -38,14 +103,42 @@ def get_bounding_boxes(image_array, cascade, size=(80,80), scale=1.3, minN=3):
     :param size: A tuple for the minimum size
     :param scale: The scaling to be used
     :param minN: Minimum neighbors
-    :return bounding_boxes: An array of [x, y, w, h] values for boxes in which faces are found
+    :param max_size: A tuple for the maximum size
+    :return bounding_boxes: An (n, 4) int32 array of [x, y, w, h] values for boxes in which faces are found
     """
-    boxes = cascade.detectMultiScale(image_array, scaleFactor=scale, minSize=size, maxSize=(300,300), minNeighbors=minN)
-    return boxes
+    height = image_array.shape[0]
+    if height <= 1000:
+        boxes = cascade.detectMultiScale(image_array, scaleFactor=scale, minSize=size, maxSize=max_size, minNeighbors=minN)
+        # detectMultiScale returns an empty tuple when nothing is found
+        return np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+    # Tall pages are split into overlapping horizontal stripes that are searched in parallel threads,
+    # the overlap is the maximum box size so every window fits entirely inside at least one stripe
+    overlap = max_size[1]
+    threads = STRIPE_THREADS if stripe_pool is not None else (os.cpu_count() or 1)
+    stripes = max(1, min(3*threads, height // overlap))
+    step = -(-height // stripes)
+    starts = range(0, height, step)
+
+    def detect(y0):
+        # Take the raw, ungrouped windows so clusters crossing a stripe boundary aren't split before grouping
+        stripe = image_array[y0:y0+step+overlap, :]
+        found = cascade.detectMultiScale(stripe, scaleFactor=scale, minSize=size, maxSize=max_size, minNeighbors=0)
+        # A window belongs to the stripe its top edge is in, windows starting in the overlap are found by the next stripe
+        return [[int(x), int(y+y0), int(w), int(h)] for x, y, w, h in found if y < step]
+
+    if stripe_pool is not None:
+        found = list(itertools.chain.from_iterable(stripe_pool.map(detect, starts)))
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            found = list(itertools.chain.from_iterable(executor.map(detect, starts)))
+    if found and minN > 0:
+        # The same grouping detectMultiScale does internally, over the windows from every stripe at once
+        found, _ = cv.groupRectangles(found, minN, 0.2)
+    return np.asarray(found, dtype=np.int32).reshape(-1, 4)
 
 
 def find_faces(img, 
-               cascade1=face_cascade, cascade2=eye_cascade, 
+               cascade1=None, cascade2=None, 
                size1=(50,50), size2=(10,10), 
                scale1=1.31, scale2=1.18, 
                minN1=3, minN2=0):
@@ -56,22 +149,44 @@ def find_faces(img,
     :param size: A tuple for the minimum size
     :param scale: The scaling to be used in get_bounding_boxes()
     :param minN: Minimum neighbors
-    :return faces_found: An array of faces found
+    :return faces_found: An array of faces found, in the coordinates of the full size image
     """
-    faces = get_bounding_boxes(img['gray'], cascade1, size1, scale1, minN1)
-    eyes = get_bounding_boxes(img['gray'], cascade2, size2, scale2, minN2)
-    face_list = []
-    for x, y, w, h in faces:
-        x1 = x+w
-        y1 = y+h
-        for testx, testy, w2, h2 in eyes:
-            if x<=testx<=x1 and y<=testy<=y1:
-                face_list.append([x, y, w, h])
-            else:
-                continue
-    face_list_s = sorted(face_list)
-    new_list = list(x for x,_ in itertools.groupby(face_list_s))
-    faces_found = np.asarray(new_list)
+    if cascade1 is None:
+        cascade1 = face_cascade
+    if cascade2 is None:
+        cascade2 = eye_cascade
+    # Detect faces on a copy of the page no bigger than 1200 pixels, then scale the boxes back up. The
+    # frontal face cascade can't find anything under its 24x24 window, so the page is never shrunk so far
+    # that size1 would fall below it
+    gray = img['gray']
+    h, w = gray.shape
+    s = max(1.0, min(max(h, w)/1200.0, min(size1)/24.0))
+    small = gray
+    if s > 1.0:
+        small = cv.resize(gray, (int(w/s), int(h/s)), interpolation=cv.INTER_AREA)
+    size1 = (max(1, int(size1[0]/s)), max(1, int(size1[1]/s)))
+    face_max = (int(300/s), int(300/s))
+    faces = get_bounding_boxes(small, cascade1, size1, scale1, minN1, max_size=face_max)
+    if len(faces) == 0:
+        return faces
+    if s > 1.0:
+        faces = (faces * s).astype(np.int32)
+    # Eyes are too small for the eye cascade's window on the downscaled page, so each face is searched at
+    # full resolution. An eye is at most half the width of its face
+    def has_eyes(face):
+        x, y, fw, fh = face
+        eye_max = max(int(fw) // 2, size2[0])
+        eyes = get_bounding_boxes(gray[y:y+fh, x:x+fw], cascade2, size2, scale2, minN2, max_size=(eye_max, eye_max))
+        return len(eyes) > 0
+
+    # The eye passes are independent and detectMultiScale releases the GIL, so run them in the worker's threads.
+    # Faces are at most about 300 pixels, too small for get_bounding_boxes to use the same pool for stripes
+    if stripe_pool is not None:
+        keep = list(stripe_pool.map(has_eyes, faces))
+    else:
+        keep = [has_eyes(face) for face in faces]
+    # Keep the faces that had at least one eye found inside their own region
+    faces_found = np.unique(faces[np.array(keep, dtype=bool)], axis=0)
     return faces_found
 
 
@@ -96,35 +211,84 @@ def get_faces(img, boxes):
     :param boxes: A set of bounding boxes to crop out faces with
     :return image_list: A list of PIL.Image objects containing faces 
     """
-    image_list = []
-    pil_image = img['image'].copy()
-    for x, y, w, h in boxes:
-        image_list.append(pil_image.crop((x, y, x+w, y+h)))
+    pil_image = img['image']
+    if pil_image.mode != 'RGB':
+        pil_image = pil_image.convert('RGB')
+    # Slicing the array gives views, only the final faces are copied into new images
+    arr = np.asarray(pil_image)
+    image_list = [Image.fromarray(arr[y:y+h, x:x+w]) for x, y, w, h in boxes]
     return image_list
 
 
 def make_thumbnails(img_list):
-    """Makes images in a list into thumbnails
+    """Makes images in a list into 100x100 thumbnails
     
     :param img_list: A list of PIL images
     :return: None - modifies the img_list in place
     """
-    for img in img_list:
-        img.thumbnail((100, 100))
+    for i, img in enumerate(img_list):
+        img_list[i] = img.resize((100, 100), Image.BILINEAR, reducing_gap=2.0)
 
         
-def get_text(img_list):
+def normalize_text(text):
+    """Joins the lines of OCR'd text, removing the hyphens from words broken across lines
+    
+    :param text: Text from Tesseract
+    :return text: The text on a single line
+    """
+    return text.replace('-\n', '').replace('\n', ' ')
+
+
+def get_text(img_list, cache=None):
     """Gets text of each image and adds it as a key to the image info dictionary
     
+    Pages are binarized with Otsu thresholding, which Tesseract reads faster than gray images, then looked up 
+    in the cache by a hash of the binary image. The rest are OCR'd with the process's Tesseract API
+    
     :param img_list: A list of image info dictionaries
-    :return None: Changes the dictionaries in place
+    :param cache: A dictionary of page text keyed by image hash, new results are added to it
+    :return None: Changes the dictionaries in place, adding 'key' and 'text'
     """
+    misses = []
     for image in img_list:
+        _, bw = cv.threshold(image['gray'], 0, 255, cv.THRESH_BINARY | cv.THRESH_OTSU)
+        digest = hashlib.blake2b(bw.tobytes(), digest_size=16)
+        digest.update(repr(TESSERACT_OPTIONS).encode())
+        image['key'] = digest.hexdigest()
+        if cache is not None and image['key'] in cache:
+            image['text'] = normalize_text(cache[image['key']])
+        else:
+            misses.append((image, bw))
+    if not misses:
+        return
+    api = get_tess_api()
+    for image, bw in misses:
         print(image['title'])
-        text = pytesseract.image_to_string(image['gray'])
-        image['text'] = text
+        api.SetImage(Image.fromarray(bw))
+        text = api.GetUTF8Text()
+        # Join hyphenated and wrapped lines so they don't hide a phrase
+        image['text'] = normalize_text(text)
+        if cache is not None:
+            cache[image['key']] = image['text']
         
         
+def process_image(gray, title, search_phrase):
+    """Gets the text of a single image and, if the phrase is on the page, its faces: runs in a worker process
+    
+    :param gray: A CV gray image array
+    :param title: The title of the image
+    :param search_phrase: A phrase to search for
+    :return key, text, faces: The OCR cache key, the text of the page and an array of faces found,
+        faces is None if the phrase isn't found
+    """
+    img = {'title': title, 'gray': gray}
+    get_text([img], ocr_cache)
+    faces = None
+    if phrase_in(img, search_phrase):
+        faces = find_faces(img)
+    return img['key'], img['text'], faces
+
+
 def phrase_in(img, search_phrase):
     """Simply tests if a phrase is in the text of a page
     
@@ -138,48 +302,52 @@ def phrase_in(img, search_phrase):
         return False
         
     
-def search_page(img, search_phrase, faces):
-    """Searches a list of images for a phrase and enacts the get_faces function on each image that has the phrase
+def search_page(img, faces):
+    """Enacts the get_faces function on an image that phrase_in() found the phrase in, see process_image()
     
-    :param img: An image dictionary to search
-    :param search_phrase: A phrase to search for in the 'text' key of each image
+    :param img: An image dictionary that has the phrase
     :param faces: Bounding boxes for faces
     :return face_list, results: Returns a tuple with the list of face pictures and a string containing it's name
     """
-    if str(search_phrase) in img['text']:
-        face_list = get_faces(img, faces)
-        results = f'Results found in file {img["title"]}'
-        return face_list, results
+    face_list = get_faces(img, faces)
+    results = f'Results found in file {img["title"]}'
+    return face_list, results
     
     
+@functools.lru_cache(maxsize=8)
+def render_banner(text, height=50):
+    """Renders text onto a white 500 pixel wide banner, reusing the raster for recently drawn banners
+    
+    Only a few are kept: per-file headers rarely repeat, the fixed no-faces band does
+    
+    :param text: The text to write on the banner
+    :param height: The height of the banner
+    :return banner: A read-only RGB image array of the banner
+    """
+    banner = Image.new('RGB', (500, height), 'white')
+    ImageDraw.Draw(banner).text((5, 5), text, font=get_font(), fill='black')
+    banner = np.asarray(banner)
+    banner.flags.writeable = False
+    return banner
+
+
 def make_contact_sheet(img_list, results):
     """Makes a contact sheet for a list of faces and a result string
     
-    :param img_list: A list of faces to be placed into a contact sheet
+    :param img_list: A list of 100x100 RGB faces to be placed into a contact sheet
     :param results: A string containing the title of the original image
     :return contact_sheet: A PIL image containing faces and text
     """
-    height = int(len(img_list)/5)
-    if len(img_list) % 5 != 0:
-        height += 1
-    if len(img_list) == 0:
-        height += 1
-    contact_sheet = Image.new('RGB', (500, (height*100)+50))
-    drawing = ImageDraw.Draw(contact_sheet)
-    drawing.rectangle([0, 0, 500, 50], outline='white', fill='white')
-    drawing.text((5, 5), results, font=FONT, fill='black')
+    header = render_banner(results)
     if len(img_list) == 0:
-        drawing.rectangle([0, 50, 500, 150], outline='white', fill='white')
-        drawing.text((5, 55), text='But there were no faces in that file!', font=FONT, fill='black')
-    x = 0
-    y = 50
-    for img in img_list:
-        contact_sheet.paste(img, (x, y))
-        if x + 100 == contact_sheet.width:
-            x = 0 
-            y += 100
-        else:
-            x += 100
+        grid = render_banner('But there were no faces in that file!', height=100)
+    else:
+        # Lay the 100x100 faces out five to a row, padding the last row with black tiles
+        rows = -(-len(img_list) // 5)
+        tiles = np.zeros((rows*5, 100, 100, 3), dtype=np.uint8)
+        tiles[:len(img_list)] = np.stack([np.asarray(img) for img in img_list])
+        grid = tiles.reshape(rows, 5, 100, 100, 3).transpose(0, 2, 1, 3, 4).reshape(rows*100, 500, 3)
+    contact_sheet = Image.fromarray(np.vstack([header, grid]))
     return contact_sheet
     
     
@@ -199,58 +367,75 @@ def concatenate_images(img1, img2):
 def do_project(img_list, phrase_to_search):
     """Combines many of the above functions to search text, get faces and return a contact sheet
     
-    :param img_list: A list of images to be searched
+    :param img_list: A list of images to be searched, 'image' is added to the ones containing the phrase
     :param phrase_to_search: A search-phrase
-    :return contact_sheet: Returns the fully concatenated contact_sheet
+    :return contact_sheet: Returns the fully concatenated contact_sheet, or a sheet saying there were no hits
     """
-    # Make a copy of a CV gray image
-    print("Converting images")
-    cvt_color(img_list)
-    # Get the text on each page
-    print("Retrieving text")
-    get_text(img_list)
+    contact_sheet = None
+    # Get the text and find the faces on each page in parallel
+    print("Retrieving text and faces")
+    # Pages are handed out a few at a time, so workers that get cache hits or pages without the phrase
+    # pick up more of the rest
+    workers = os.cpu_count() or 1
+    chunksize = max(1, len(img_list) // (workers*4))
+    cache = load_ocr_cache()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(cache,)) as executor:
+        processed = list(executor.map(process_image,
+                                      [img['gray'] for img in img_list],
+                                      [img['title'] for img in img_list],
+                                      itertools.repeat(phrase_to_search),
+                                      chunksize=chunksize))
+    for key, text, faces in processed:
+        cache[key] = text
+    save_ocr_cache(cache)
     print("Getting faces")
-    for img in img_list:
+    for img, (key, text, faces) in zip(img_list, processed):
+        img['text'] = text
         print(img['title'])
-        faces = find_faces(img)
-        if phrase_in(img, phrase_to_search):
-            images, results = search_page(img, phrase_to_search, faces)
+        # The worker only looks for faces on pages that have the phrase
+        if faces is not None:
+            # Only pages with the phrase on them need decoding for PIL
+            img['image'] = Image.open(io.BytesIO(img['data']))
+            images, results = search_page(img, faces)
             make_thumbnails(images)
-            if img == img_list[0]:
-                contact_sheet = make_contact_sheet(images, results)
+            temp_sheet = make_contact_sheet(images, results)
+            if contact_sheet is None:
+                contact_sheet = temp_sheet
             else:
-                temp_sheet = make_contact_sheet(images, results)
-                contact_sheet = concatenate_images(contact_sheet, temp_sheet)   
+                contact_sheet = concatenate_images(contact_sheet, temp_sheet)
+    if contact_sheet is None:
+        # Just the header, there's no file to say had no faces
+        contact_sheet = Image.fromarray(render_banner(f'No hits for {phrase_to_search}'))
     return contact_sheet
     
-# Get images open and start the dictionaries
-img_list = []
-with zipfile.ZipFile('readonly/small_img.zip') as myzip:
-    print("Getting small_img.zip files")
-    for info_file in myzip.namelist():
-        print(info_file)
-        img_list.append({'title': info_file, 
-                         'image': Image.open(myzip.extract(info_file)), 
-                         'cv': cv.imread(myzip.extract(info_file))})
-        
-big_img_list = []
-with zipfile.ZipFile('readonly/images.zip') as myzip2:
-    print("Getting images.zip files")
-    for info_file in myzip2.namelist():
-        print(info_file)
-        big_img_list.append({'title': info_file, 
-                             'image': Image.open(myzip2.extract(info_file)), 
-                             'cv': cv.imread(myzip2.extract(info_file))})
-
-        
-# Search the text and get faces
-print("Searching for 'Chris' in the small_img.zip")
-chris = do_project(img_list, 'Chris')
-display(chris)
-print("Searching for 'Mark' in the images.zip")
-mark = do_project(big_img_list, 'Mark')
-display(mark)
+if __name__ == '__main__':
+    # Get images open and start the dictionaries
+    img_list = []
+    with zipfile.ZipFile('readonly/small_img.zip') as myzip:
+        print("Getting small_img.zip files")
+        for info_file in myzip.namelist():
+            print(info_file)
+            data = myzip.read(info_file)
+            img_list.append({'title': info_file, 
+                             'data': data, 
+                             'gray': cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_GRAYSCALE)})
 
+    big_img_list = []
+    with zipfile.ZipFile('readonly/images.zip') as myzip2:
+        print("Getting images.zip files")
+        for info_file in myzip2.namelist():
+            print(info_file)
+            data = myzip2.read(info_file)
+            big_img_list.append({'title': info_file, 
+                                 'data': data, 
+                                 'gray': cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_GRAYSCALE)})
 
 
-    
+    # Search the text and get faces
+    print("Searching for 'Chris' in the small_img.zip")
+    chris = do_project(img_list, 'Chris')
+    # Low PNG compression, these are intermediate results and encoding at the default level is slow
+    chris.save('chris.png', optimize=False, compress_level=1)
+    print("Searching for 'Mark' in the images.zip")
+    mark = do_project(big_img_list, 'Mark')
+    mark.save('mark.png', optimize=False, compress_level=1)